@@ -14,8 +14,77 @@
 
 """
 
+import collections
+import itertools
+import logging
+import time
+
 import omero
 import pytest
+from helpers import fromPixelsBytes
+
+logger = logging.getLogger(__name__)
+
+
+def getPlanesPrefetch(pixels, zctList, depth=2):
+    """
+    Like PixelsWrapper.getPlanes, but keeps requests for the next depth
+    planes in flight while the caller handles the current one, so at
+    most depth + 1 planes are held at once. depth must be at least 1.
+    As with getPlanes, if reading a plane fails the store is closed and
+    the read error raised, with any failure of that close only logged;
+    otherwise a failure of the close is raised once every plane has been
+    returned.
+    """
+    if depth < 1:
+        raise ValueError("depth must be at least 1: %s" % depth)
+    sizeX = pixels.getSizeX()
+    sizeY = pixels.getSizeY()
+    requests = (((z, c, t), sizeX, sizeY) for z, c, t in zctList)
+    return _prefetch(pixels, "getPlane", requests, depth)
+
+
+def getTilesPrefetch(pixels, zctTileList, depth=2):
+    """
+    Like PixelsWrapper.getTiles, with the prefetching and error handling
+    of getPlanesPrefetch. Each tile is given as (x, y, width, height).
+    """
+    if depth < 1:
+        raise ValueError("depth must be at least 1: %s" % depth)
+    requests = (((z, c, t) + tuple(tile), tile[2], tile[3])
+                for z, c, t, tile in zctTileList)
+    return _prefetch(pixels, "getTile", requests, depth)
+
+
+def _prefetch(pixels, method, requests, depth):
+    """
+    Yield the arrays for requests of (args, sizeX, sizeY), calling the
+    asynchronous form of method on the RawPixelsStore with args
+    """
+    pixelsType = pixels.getPixelsType().value
+    rps = pixels._prepareRawPixelsStore()
+    begin = getattr(rps, "begin_" + method)
+    end = getattr(rps, "end_" + method)
+    pending = collections.deque()
+    try:
+        for args, w, h in itertools.islice(requests, depth):
+            pending.append((begin(*args), w, h))
+        while pending:
+            r, w, h = pending.popleft()
+            raw = end(r)
+            for args, nw, nh in itertools.islice(requests, 1):
+                pending.append((begin(*args), nw, nh))
+            yield fromPixelsBytes(raw, pixelsType, w, h)
+    except GeneratorExit:
+        rps.close()
+        raise
+    except Exception:
+        try:
+            rps.close()
+        except Exception:
+            logger.error("Failed to close RawPixelsStore", exc_info=True)
+        raise
+    rps.close()
 
 
 class TestPixels (object):
@@ -242,6 +311,170 @@ class TestPixels (object):
             assert not e.close
             assert found == 1
 
+    def testGetPlanesPrefetch(self):
+        """
+        Planes read with requests for the next ones already in flight
+        must be the same as those from getPlanes, and are timed against it
+        """
+        image = self.image
+        pixels = image.getPrimaryPixels()
+
+        zctList = []
+        for z in range(image.getSizeZ()):
+            for c in range(image.getSizeC()):
+                for t in range(image.getSizeT()):
+                    zctList.append((z, c, t))
+
+        startTime = time.time()
+        expected = list(pixels.getPlanes(zctList))
+        t1 = time.time() - startTime
+
+        startTime = time.time()
+        planes = list(getPlanesPrefetch(pixels, zctList, depth=4))
+        t2 = time.time() - startTime
+        print "%d planes: getPlanes = %s secs, prefetch = %s secs" % (
+            len(zctList), t1, t2)
+
+        assert len(expected) == len(planes)
+        for a, b in zip(expected, planes):
+            assert b.dtype.isnative
+            assert (a == b).all()
+
+    @pytest.mark.parametrize("depth", [0, -1])
+    def testGetPlanesPrefetchBadDepth(self, depth):
+        pixels = self.image.getPrimaryPixels()
+        with pytest.raises(ValueError):
+            getPlanesPrefetch(pixels, ((0, 0, 0),), depth=depth)
+
+    @pytest.mark.parametrize("depth", [1, 2, 4])
+    @pytest.mark.parametrize("mock", [
+        # good_calls, close_fails, planes found, close error raised
+        (1, False, 1, False),
+        (2, True, 2, True),
+        (1, True, 1, False),
+    ], ids=["OnGetPlane", "OnClose", "OnBoth"])
+    def testGetPlanesPrefetchException(self, depth, mock):
+        """
+        getPlanesPrefetch must keep the exception handling of getPlanes
+        tested above, whatever the prefetch depth
+
+        See #5156
+        """
+        good_calls, close_fails, expected, close = mock
+        pixels = self.image.getPrimaryPixels()
+
+        # Replace service creation with a mock
+        pixels._prepareRawPixelsStore = lambda: MockRawPixelsStore(
+            pixels, good_calls=good_calls, close_fails=close_fails)
+
+        found = 0
+        try:
+            for x in getPlanesPrefetch(
+                    pixels, ((0, 0, 0), (1, 1, 1)), depth=depth):
+                found += 1
+            raise AssertionError("Should throw")
+        except AssertionError:
+            raise
+        except Exception, e:
+            assert e.close == close
+            assert found == expected
+
+    def testGetTilesPrefetch(self):
+        """
+        Tiles read with requests for the next ones already in flight
+        must be the same as those from getTiles, and are timed against it
+        """
+        image = self.image
+        pixels = image.getPrimaryPixels()
+
+        tiles = ((0, 0, 5, 3), (5, 0, 5, 3), (50, 100, 10, 20))
+        zctTileList = []
+        for z in range(image.getSizeZ()):
+            for c in range(image.getSizeC()):
+                for t in range(image.getSizeT()):
+                    for tile in tiles:
+                        zctTileList.append((z, c, t, tile))
+
+        startTime = time.time()
+        expected = list(pixels.getTiles(zctTileList))
+        t1 = time.time() - startTime
+
+        startTime = time.time()
+        tiles = list(getTilesPrefetch(pixels, zctTileList, depth=4))
+        t2 = time.time() - startTime
+        print "%d tiles: getTiles = %s secs, prefetch = %s secs" % (
+            len(zctTileList), t1, t2)
+
+        assert len(expected) == len(tiles)
+        for a, b in zip(expected, tiles):
+            assert b.dtype.isnative
+            assert a.shape == b.shape
+            assert (a == b).all()
+
+    @pytest.mark.parametrize("depth", [0, -1])
+    def testGetTilesPrefetchBadDepth(self, depth):
+        pixels = self.image.getPrimaryPixels()
+        with pytest.raises(ValueError):
+            getTilesPrefetch(pixels, ((0, 0, 0, (0, 0, 5, 3)),), depth=depth)
+
+    @pytest.mark.parametrize("depth", [1, 2, 4])
+    @pytest.mark.parametrize("mock", [
+        # good_calls, close_fails, tiles found, close error raised
+        (1, False, 1, False),
+        (2, True, 2, True),
+        (1, True, 1, False),
+    ], ids=["OnGetTile", "OnClose", "OnBoth"])
+    def testGetTilesPrefetchException(self, depth, mock):
+        """
+        getTilesPrefetch must keep the exception handling of getPlanes,
+        whatever the prefetch depth
+
+        See #5156
+        """
+        good_calls, close_fails, expected, close = mock
+        pixels = self.image.getPrimaryPixels()
+
+        # Replace service creation with a mock
+        pixels._prepareRawPixelsStore = lambda: MockRawPixelsStore(
+            pixels, good_calls=good_calls, close_fails=close_fails)
+
+        found = 0
+        try:
+            for x in getTilesPrefetch(
+                    pixels, ((0, 0, 0, (0, 0, 5, 3)), (1, 1, 1, (5, 0, 5, 3))),
+                    depth=depth):
+                found += 1
+            raise AssertionError("Should throw")
+        except AssertionError:
+            raise
+        except Exception, e:
+            assert e.close == close
+            assert found == expected
+
+    def testRepeatedTileReads(self):
+        """
+        Times repeated and overlapping getTile calls, as made by a viewer
+        panning around a region, against reading each distinct tile once.
+        The difference is the round trips a client-side tile cache in the
+        gateway would save. Repeated reads must return the same data
+        """
+        pixels = self.image.getPrimaryPixels()
+        tiles = [(0, 0, 5, 3), (5, 0, 5, 3), (0, 0, 10, 3), (0, 0, 5, 3)]
+        repeats = 5
+
+        startTime = time.time()
+        first = dict((tile, pixels.getTile(0, 0, 0, tile))
+                     for tile in set(tiles))
+        t1 = time.time() - startTime
+
+        startTime = time.time()
+        for n in range(repeats):
+            for tile in tiles:
+                assert (first[tile] == pixels.getTile(0, 0, 0, tile)).all()
+        t2 = time.time() - startTime
+        print "%d distinct tiles = %s secs, %d repeated reads = %s secs" % (
+            len(first), t1, repeats * len(tiles), t2)
+
     def testGetHistogram(self, gatewaywrapper):
         """
         Tests we get data of the right size and close rawPixelsStore
@@ -285,6 +518,28 @@ class MockRawPixelsStore(object):
             self.good_calls -= 1
             return "0"*(2*self.pixels.getSizeX()*self.pixels.getSizeY())
 
+    def begin_getPlane(self, *args):
+        # Like Ice, report any failure when the result is collected
+        return args
+
+    def end_getPlane(self, args):
+        return self.getPlane(*args)
+
+    def getTile(self, z, c, t, x, y, w, h):
+        if self.good_calls == 0:
+            e = Exception("MOCK EXCEPTION")
+            e.close = False
+            raise e
+        else:
+            self.good_calls -= 1
+            return "0"*(2*w*h)
+
+    def begin_getTile(self, *args):
+        return args
+
+    def end_getTile(self, args):
+        return self.getTile(*args)
+
     def close(self, *args):
         if self.close_fails:
             e = Exception("MOCK CLOSE EXCEPTION")
@@ -24,8 +24,15 @@
 
 """
 
+import time
+
+import omero
 import omero.util.script_utils as scriptUtil
-from numpy import arange, uint8
+from omero.util.concurrency import get_event
+from numpy import arange, dtype, frombuffer, fromstring, uint8
+
+# OMERO PixelsType values whose numpy type has a different name
+PIXELS_TYPE_DTYPES = {"float": "float32", "double": "float64"}
 
 
 def createTestImage(session, imageName="imageName"):
@@ -58,3 +65,56 @@ def createImageWithPixels(client, name, sizes={}):
             sizeX, sizeY, sizeZ, sizeT, channelList, pixelsType,
             name, description=None)
         return id
+
+
+def toPixelsBytes(array, pixelsType):
+    """
+    Convert a numpy array to the big-endian byte string expected by
+    RawPixelsStore.setTile and setPlane, in one step rather than via a
+    list of values. pixelsType is the value of an OMERO PixelsType,
+    e.g. 'uint16'
+    """
+    name = PIXELS_TYPE_DTYPES.get(pixelsType, pixelsType)
+    return array.astype(dtype(name).newbyteorder(">")).tostring()
+
+
+def fromPixelsBytes(buf, pixelsType, sizeX, sizeY):
+    """
+    Decode the big-endian bytes returned by RawPixelsStore.getPlane or
+    getTile into a native-endian 2D numpy array of sizeY rows by sizeX
+    columns, as PixelsWrapper.getPlane returns.
+    pixelsType is the value of an OMERO PixelsType, e.g. 'uint16'
+    """
+    name = PIXELS_TYPE_DTYPES.get(pixelsType, pixelsType)
+    plane = fromstring(buf, dtype(name).newbyteorder(">"))
+    return plane.astype(dtype(name)).reshape(sizeY, sizeX)
+
+
+def mask_arrays(col):
+    """
+    Return the bytes of each row of a MaskColumn as uint8 numpy arrays.
+    Ice delivers each row as a string, so these are views onto the
+    received buffers rather than copies
+    """
+    return [frombuffer(b, dtype=uint8) for b in col.bytes]
+
+
+def waitForPyramid(rps, pixelsId, timeout=60, ctx=None):
+    """
+    Block until the pyramid for pixelsId has been generated or timeout
+    seconds have passed, by calling rps.setPixelsId and waiting for the
+    backOff given by each MissingPyramidException (capped to the time
+    remaining). Returns True if the pixels could be set on rps.
+    """
+    event = get_event("waitForPyramid")
+    deadline = time.time() + timeout
+    while True:
+        try:
+            rps.setPixelsId(pixelsId, True, ctx)
+            return True
+        except omero.MissingPyramidException, mpm:
+            assert pixelsId == mpm.pixelsID
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            event.wait(min(mpm.backOff / 1000.0, remaining))
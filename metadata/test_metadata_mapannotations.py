@@ -31,6 +31,7 @@ from omero.util.metadata_mapannotations import (
     CanonicalMapAnnotation, MapAnnotationManager)
 import pytest
 import sys
+import time
 
 pythonminver = pytest.mark.skipif(sys.version_info < (2, 7),
                                   reason="requires python2.7")
@@ -127,3 +128,41 @@ class TestMapAnnotationManager(ITest):
         assert_equal_map_value(rs[1].getMapValue(), [
             NamedValue('a', '2'), NamedValue('b', '3')])
         assert unwrap(rs[1].getNs()) == ns1
+
+    @pytest.mark.parametrize('count', (500, 2000))
+    def test_add_from_namespace_query_scale(self, count):
+        """
+        Time loading many existing annotations by namespace and then
+        matching the same number of new annotations against them by
+        primary key. Every new annotation should update an existing one
+        """
+        ns = self.uuid()
+        mas = []
+        for n in range(count):
+            ma = MapAnnotationI()
+            ma.setNs(wrap(ns))
+            ma.setMapValue([NamedValue('a', str(n))])
+            mas.append(ma)
+        mids = self.update.saveAndReturnIds(mas)
+
+        pks = ['a']
+        mgr = MapAnnotationManager()
+        startTime = time.time()
+        mgr.add_from_namespace_query(self.sf, ns, pks)
+        t1 = time.time() - startTime
+        assert len(mgr.mapanns) == count
+
+        startTime = time.time()
+        for n in range(count):
+            ma = MapAnnotationI()
+            ma.setNs(wrap(ns))
+            ma.setMapValue([NamedValue('a', str(n)), NamedValue('b', 'x')])
+            mgr.add(CanonicalMapAnnotation(ma, pks))
+        t2 = time.time() - startTime
+        print "load %d = %s secs, match %d = %s secs" % (
+            count, t1, count, t2)
+
+        cmas = mgr.get_map_annotations()
+        assert len(cmas) == count
+        assert set(unwrap(c.get_mapann().getId()) for c in cmas) == \
+            set(mids)
@@ -29,6 +29,7 @@ from omero.util import pydict_text_io
 
 import pytest
 import sys
+import time
 
 pythonminver = pytest.mark.skipif(sys.version_info < (2, 7),
                                   reason="requires python2.7")
@@ -116,6 +117,32 @@ class TestPydictTextIo(ITest):
             fileobj, session=self.client.getSession())
         assert data == {'a': 2}
 
+    @pytest.mark.parametrize('format', ['json', 'yaml'])
+    def test_load_repeated(self, format):
+        """
+        Time repeated loads of the same remote file, as done when one
+        config is used for many plates. Each load must return its own
+        dict so that callers modifying one result do not affect the next
+        """
+        if format == 'json':
+            content = self.getTestJson()
+        else:
+            content = self.getTestYaml()
+        fa = self.make_file_annotation(
+            name='test.%s' % format, binary=content, mimetype=format)
+        fileobj = 'OriginalFile:%d' % unwrap(fa.file.id)
+        session = self.client.getSession()
+
+        times = []
+        for n in range(10):
+            startTime = time.time()
+            data = pydict_text_io.load(fileobj, session=session)
+            times.append(time.time() - startTime)
+            assert data == {'a': 2}
+            data['a'] = n + 100
+        print "first load = %s secs, mean of next %d = %s secs" % (
+            times[0], len(times) - 1, sum(times[1:]) / (len(times) - 1))
+
     def test_load_fromstring(self):
         content = self.getTestJson()
         data = pydict_text_io.load(content)
@@ -33,6 +33,7 @@ import pytest
 
 from omero import columns
 from omero.rtypes import rint
+from helpers import mask_arrays
 
 
 class TestBackwardsCompatibility(ITest):
@@ -40,9 +41,10 @@ class TestBackwardsCompatibility(ITest):
     # def setUp(self):
     #     super(BackwardsCompatibilityTest, self).setUp()
 
-    def uploadHdf5(self, file):
+    def decompressHdf5(self, file):
         """
-        Decompress the BZ2-compressed HDF5 test file and upload to server.
+        Decompress the BZ2-compressed HDF5 test file to a temporary file
+        and return its path.
         file should be relative to the directory containing this file.
         """
         dir = os.path.dirname(os.path.realpath(__file__))
@@ -53,9 +55,16 @@ class TestBackwardsCompatibility(ITest):
         tmpf.write(bzf.read())
         bzf.close()
         tmpf.close()
+        return tmpf.name
 
+    def uploadHdf5(self, file):
+        """
+        Decompress the BZ2-compressed HDF5 test file and upload to server.
+        file should be relative to the directory containing this file.
+        """
+        tmpname = self.decompressHdf5(file)
         ofile = self.client.upload(
-            tmpf.name, name=file, type='application/x-hdf')
+            tmpname, name=file, type='application/x-hdf')
         print "Uploaded OriginalFile:", ofile.getId().val
         return ofile
 
@@ -72,10 +81,7 @@ class TestBackwardsCompatibility(ITest):
         return mask
 
     def checkMaskCol(self, test):
-        def arr(x):
-            import numpy
-            import tables
-            return numpy.fromstring(x, count=len(x), dtype=tables.UInt8Atom())
+        masks = mask_arrays(test)
 
         assert 1 == test.imageId[0]
         assert 3 == test.theZ[0]
@@ -84,7 +90,7 @@ class TestBackwardsCompatibility(ITest):
         assert 9 == test.y[0]
         assert 11 == test.w[0]
         assert 13 == test.h[0]
-        assert [15] == arr(test.bytes[0])
+        assert [15] == masks[0]
 
         assert 2 == test.imageId[1]
         assert 4 == test.theZ[1]
@@ -95,7 +101,7 @@ class TestBackwardsCompatibility(ITest):
         assert 14 == test.h[1]
 
         x = [16, 17, 18, 19, 20]
-        y = arr(test.bytes[1])
+        y = masks[1]
         for i in range(len(x)):
             assert x[i] == y[i]
 
@@ -318,3 +324,48 @@ class TestBackwardsCompatibility(ITest):
         with pytest.raises(omero.ApiUsageException) as exc:
             table.setAllMetadata({'a': rint(1)})
         assert exc.value.message == expected
+
+    @pytest.mark.parametrize('complib', ('zlib', 'blosc'))
+    def testCompressedCopy_4_4_5(self, complib):
+        """
+        Check that the reference table rewritten with PyTables compression
+        filters is read by the server with the same values as the
+        uncompressed original
+        """
+        import tables
+
+        src = self.decompressHdf5("service-reference-dev_4_4_5.h5.bz2")
+        dst = src + "." + complib
+        reference = None
+        compressed = None
+        try:
+            filters = tables.Filters(
+                complevel=5, complib=complib, shuffle=True)
+            tables.copy_file(src, dst, overwrite=True, filters=filters)
+            print "%s: %d bytes, %s: %d bytes" % (
+                src, os.path.getsize(src), complib, os.path.getsize(dst))
+
+            grid = self.client.sf.sharedResources()
+            ofile = self.client.upload(
+                src, name="reference.h5", type='application/x-hdf')
+            reference = grid.openTable(ofile)
+            ofile = self.client.upload(
+                dst, name="compressed.h5", type='application/x-hdf')
+            compressed = grid.openTable(ofile)
+
+            assert [h.name for h in reference.getHeaders()] == \
+                [h.name for h in compressed.getHeaders()]
+            assert compressed.getNumberOfRows() == 2
+            expected = reference.readCoordinates([0, 1])
+            data = compressed.readCoordinates([0, 1])
+            for n in range(9):
+                assert expected.columns[n].values == data.columns[n].values
+            self.checkMaskCol(data.columns[9])
+        finally:
+            if reference:
+                reference.close()
+            if compressed:
+                compressed.close()
+            for path in (src, dst):
+                if os.path.exists(path):
+                    os.remove(path)
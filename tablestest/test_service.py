@@ -25,6 +25,8 @@
 """
 
 import path
+import time
+import numpy
 import omero
 import omero.tables
 from omero.testlib import ITest
@@ -32,6 +34,77 @@ import pytest
 
 from omero import columns
 from omero.rtypes import rfloat, rint, rlong, rstring, unwrap, wrap
+from helpers import mask_arrays
+
+
+def as_recarray(data):
+    """
+    Decode an omero.grid.Data of scalar columns into a numpy record
+    array, converting each column in a single step rather than row by row
+    """
+    return numpy.rec.fromarrays(
+        [numpy.asarray(c.values) for c in data.columns],
+        names=[c.name for c in data.columns])
+
+
+def iter_chunks(table, colNumbers, chunkRows):
+    """
+    Yield omero.grid.Data for successive blocks of at most chunkRows rows.
+    The read for the next block is issued asynchronously before the
+    current one is handed to the caller, so at most two blocks are held
+    on the client at any time. chunkRows must be at least 1
+    """
+    if chunkRows < 1:
+        raise ValueError("chunkRows must be at least 1: %s" % chunkRows)
+    return _iter_chunks(table, colNumbers, chunkRows)
+
+
+def _iter_chunks(table, colNumbers, chunkRows):
+    rows = table.getNumberOfRows()
+    start = 0
+    pending = None
+    if rows:
+        pending = table.begin_read(colNumbers, 0, min(chunkRows, rows))
+    while pending is not None:
+        data = table.end_read(pending)
+        start += chunkRows
+        pending = None
+        if start < rows:
+            pending = table.begin_read(
+                colNumbers, start, min(start + chunkRows, rows))
+        yield data
+
+
+def describe_tables(grid, ofiles):
+    """
+    Open each of ofiles and return a list of (table, headers, rows,
+    metadata) tuples. All openTable calls, and then all metadata calls,
+    are issued asynchronously so the round trips overlap rather than
+    being made one table at a time. If any call fails every table which
+    was opened is closed before the error is raised
+    """
+    opened = [grid.begin_openTable(ofile) for ofile in ofiles]
+    tables = []
+    try:
+        for r in opened:
+            tables.append(grid.end_openTable(r))
+        pending = [(t.begin_getHeaders(), t.begin_getNumberOfRows(),
+                    t.begin_getAllMetadata()) for t in tables]
+        return [(t, t.end_getHeaders(h), t.end_getNumberOfRows(n),
+                 t.end_getAllMetadata(m))
+                for t, (h, n, m) in zip(tables, pending)]
+    except Exception:
+        for r in opened[len(tables) + 1:]:
+            try:
+                tables.append(grid.end_openTable(r))
+            except Exception:
+                pass
+        for t in tables:
+            try:
+                t.close()
+            except Exception:
+                pass
+        raise
 
 
 class TestTables(ITest):
@@ -49,10 +122,7 @@ class TestTables(ITest):
         return mask
 
     def checkMaskCol(self, test):
-        def arr(x):
-            import numpy
-            import tables
-            return numpy.fromstring(x, count=len(x), dtype=tables.UInt8Atom())
+        masks = mask_arrays(test)
 
         assert 1 == test.imageId[0]
         assert 3 == test.theZ[0]
@@ -61,7 +131,7 @@ class TestTables(ITest):
         assert 9 == test.y[0]
         assert 11 == test.w[0]
         assert 13 == test.h[0]
-        assert [15] == arr(test.bytes[0])
+        assert [15] == masks[0]
 
         assert 2 == test.imageId[1]
         assert 4 == test.theZ[1]
@@ -72,7 +142,7 @@ class TestTables(ITest):
         assert 14 == test.h[1]
 
         x = [16, 17, 18, 19, 20]
-        y = arr(test.bytes[1])
+        y = masks[1]
         for i in range(len(x)):
             assert x[i] == y[i]
 
@@ -686,4 +756,311 @@ class TestTables(ITest):
         table.delete()
         table.close()
 
+    def testColumnarRead(self):
+        """
+        Reading whole columns in one call and decoding them into a
+        record array must give the same values as reading one row at a
+        time. The timings printed compare one round trip per row with a
+        single read, and, on that same read, decoding with as_recarray
+        with building row tuples from the column lists
+        """
+        grid = self.client.sf.sharedResources()
+        table = grid.newTable(1, "/test")
+        assert table
+
+        rows = 1000
+        lcol = columns.LongColumnI('lc', 'long col', range(rows))
+        dcol = columns.DoubleColumnI(
+            'dc', 'double col', [x * 0.5 for x in range(rows)])
+        table.initialize([lcol, dcol])
+        table.addData([lcol, dcol])
+
+        try:
+            startTime = time.time()
+            expected = []
+            for hit in range(rows):
+                data = table.read([0, 1], hit, hit + 1)
+                expected.append(tuple(c.values[0] for c in data.columns))
+            t1 = time.time() - startTime
+            print "row-by-row read of %d rows = %s secs" % (rows, t1)
+
+            startTime = time.time()
+            data = table.read([0, 1], 0, rows)
+            t2 = time.time() - startTime
+            print "single read of %d rows = %s secs" % (rows, t2)
+
+            startTime = time.time()
+            listed = zip(*[c.values for c in data.columns])
+            t3 = time.time() - startTime
+            print "list decode of %d rows = %s secs" % (rows, t3)
+
+            startTime = time.time()
+            arr = as_recarray(data)
+            t4 = time.time() - startTime
+            print "recarray decode of %d rows = %s secs" % (rows, t4)
+
+            assert arr.dtype.names == ('lc', 'dc')
+            assert arr.tolist() == expected
+            assert listed == expected
+        finally:
+            table.delete()
+            table.close()
+
+    def testIterChunks(self):
+        """
+        Iterating a table in chunks returns every row exactly once, in
+        order, without reading the whole table in a single call
+        """
+        grid = self.client.sf.sharedResources()
+        table = grid.newTable(1, "/test")
+        assert table
+
+        rows = 2500
+        lcol = columns.LongColumnI('lc', 'long col', range(rows))
+        table.initialize([lcol])
+        table.addData([lcol])
+
+        try:
+            sizes = []
+            values = []
+            for data in iter_chunks(table, [0], 1000):
+                sizes.append(len(data.columns[0].values))
+                values.extend(data.columns[0].values)
+            assert [1000, 1000, 500] == sizes
+            assert range(rows) == values
+            assert values == table.readCoordinates(
+                range(table.getNumberOfRows())).columns[0].values
+        finally:
+            table.delete()
+            table.close()
+
+    def testIterChunksEmptyTable(self):
+        grid = self.client.sf.sharedResources()
+        table = grid.newTable(1, "/test")
+        assert table
+        table.initialize([columns.LongColumnI('lc')])
+        try:
+            assert [] == list(iter_chunks(table, [0], 1000))
+        finally:
+            table.delete()
+            table.close()
+
+    @pytest.mark.parametrize('chunkRows', (0, -1))
+    def testIterChunksInvalidSize(self, chunkRows):
+        grid = self.client.sf.sharedResources()
+        table = grid.newTable(1, "/test")
+        assert table
+        lcol = columns.LongColumnI('lc', 'long col', range(10))
+        table.initialize([lcol])
+        table.addData([lcol])
+        try:
+            with pytest.raises(ValueError):
+                iter_chunks(table, [0], chunkRows)
+        finally:
+            table.delete()
+            table.close()
+
+    @pytest.mark.parametrize('rows', (1000, 10000, 100000))
+    def testGetWhereListLatency(self, rows):
+        """
+        Records getWhereList latency for id lookups as the table grows,
+        the access pattern used when querying screens by Well or Image id
+        """
+        grid = self.client.sf.sharedResources()
+        table = grid.newTable(1, "/test")
+        assert table
+
+        wcol = columns.WellColumnI('Well', 'well col', range(rows))
+        icol = columns.ImageColumnI(
+            'Image', 'image col', [x * 2 for x in range(rows)])
+        table.initialize([wcol, icol])
+        table.addData([wcol, icol])
+
+        try:
+            queries = 20
+            step = rows // queries
+            startTime = time.time()
+            for n in range(queries):
+                well = n * step
+                hits = table.getWhereList(
+                    '(Well==w)', {"w": rlong(well)}, 0, 0, 0)
+                assert [well] == hits
+            t = (time.time() - startTime) / queries
+            print "getWhereList over %d rows = %s secs per query" % (rows, t)
+
+            hits = table.getWhereList(
+                '(Image==i)', {"i": rlong(2 * (rows - 1))}, 0, 0, 0)
+            assert [rows - 1] == hits
+        finally:
+            table.delete()
+            table.close()
+
+    def testDescribeTables(self):
+        """
+        Headers, row counts and metadata of several tables fetched
+        together must match those fetched one table at a time
+        """
+        grid = self.client.sf.sharedResources()
+        ofiles = []
+        for n in range(5):
+            table = grid.newTable(1, "/test")
+            assert table
+            lc = columns.LongColumnI('lc', 'desc', range(n + 1))
+            table.initialize([lc])
+            table.addData([lc])
+            table.setMetadata("n", rint(n))
+            ofiles.append(table.getOriginalFile())
+            table.close()
+
+        described = []
+        try:
+            startTime = time.time()
+            expected = []
+            for ofile in ofiles:
+                table = grid.openTable(ofile)
+                expected.append((
+                    [h.name for h in table.getHeaders()],
+                    table.getNumberOfRows(),
+                    unwrap(table.getAllMetadata())))
+                table.close()
+            t1 = time.time() - startTime
+            print "serial describe of %d tables = %s secs" % (
+                len(ofiles), t1)
+
+            startTime = time.time()
+            described = describe_tables(grid, ofiles)
+            t2 = time.time() - startTime
+            print "batched describe of %d tables = %s secs" % (
+                len(ofiles), t2)
+
+            for n, (table, headers, rows, metadata) in enumerate(described):
+                assert expected[n] == (
+                    [h.name for h in headers], rows, unwrap(metadata))
+                assert n + 1 == rows
+                assert n == unwrap(metadata["n"])
+        finally:
+            for table, headers, rows, metadata in described:
+                table.close()
+            for ofile in ofiles:
+                table = grid.openTable(ofile)
+                table.delete()
+                table.close()
+
+    def testRepeatedOpenAcrossSessions(self):
+        """
+        Opening the same table many times from several sessions must
+        return the same data each time, and must still apply the
+        permission checks of each session even while the file is open
+        elsewhere
+        """
+        group = self.new_group(perms="rwr---")
+        user1 = self.new_client(group)
+        user2 = self.new_client(group)
+
+        table = user1.sf.sharedResources().newTable(1, "/test")
+        assert table
+        lc = columns.LongColumnI('lc', 'desc', range(100))
+        table.initialize([lc])
+        table.addData([lc])
+        ofile = table.getOriginalFile()
+        table.close()
+
+        try:
+            times = []
+            for client in [user1, user2] * 5:
+                sr = client.sf.sharedResources()
+                startTime = time.time()
+                t = sr.openTable(ofile)
+                times.append(time.time() - startTime)
+                try:
+                    assert 100 == t.getNumberOfRows()
+                    assert range(100) == t.read([0], 0, 0).columns[0].values
+                finally:
+                    t.close()
+            print "first openTable = %s secs, mean of next %d = %s secs" % (
+                times[0], len(times) - 1, sum(times[1:]) / (len(times) - 1))
+
+            # A user in another group must be refused however recently
+            # the file was opened by permitted sessions
+            other = self.new_client(self.new_group())
+            with pytest.raises(omero.SecurityViolation):
+                other.sf.sharedResources().openTable(ofile)
+        finally:
+            table = user1.sf.sharedResources().openTable(ofile)
+            table.delete()
+            table.close()
+
+    @pytest.mark.parametrize('batch_size', (10000, 100000, 500000))
+    def testAddDataThroughput(self, batch_size):
+        """
+        Appends a million rows in batches of batch_size and records the
+        throughput, since each addData call flushes the file
+        """
+        grid = self.client.sf.sharedResources()
+        table = grid.newTable(1, "/test")
+        assert table
+
+        rows = 1000000
+        lc = columns.LongColumnI('lc', 'desc')
+        dc = columns.DoubleColumnI('dc', 'desc')
+        table.initialize([lc, dc])
+
+        try:
+            values = numpy.arange(rows)
+            startTime = time.time()
+            for start in range(0, rows, batch_size):
+                batch = values[start:start + batch_size]
+                lc.values = batch.tolist()
+                dc.values = (batch * 0.5).tolist()
+                table.addData([lc, dc])
+            t = time.time() - startTime
+            print "addData of %d rows in batches of %d = %s secs " \
+                "(%d rows/sec)" % (rows, batch_size, t, rows / t)
+
+            assert rows == table.getNumberOfRows()
+            last = table.read([0, 1], rows - 1, rows)
+            assert [rows - 1] == last.columns[0].values
+            assert [(rows - 1) * 0.5] == last.columns[1].values
+        finally:
+            table.delete()
+            table.close()
+
+    def testMaskBytesFromBuffers(self):
+        """
+        Mask bytes may be sent as strings built from numpy arrays rather
+        than as lists of ints, and read back without per-value decoding
+        """
+        grid = self.client.sf.sharedResources()
+        table = grid.newTable(1, "/test")
+        assert table
+
+        rows = 10
+        masks = [numpy.random.randint(0, 256, 100000).astype(numpy.uint8)
+                 for n in range(rows)]
+        mask = columns.MaskColumnI('mask', 'desc', None)
+        mask.imageId = range(rows)
+        mask.theZ = [0] * rows
+        mask.theT = [0] * rows
+        mask.x = [0.0] * rows
+        mask.y = [0.0] * rows
+        mask.w = [1000.0] * rows
+        mask.h = [100.0] * rows
+        mask.bytes = [m.tostring() for m in masks]
+
+        table.initialize([mask])
+        try:
+            startTime = time.time()
+            table.addData([mask])
+            data = table.readCoordinates(range(rows))
+            read = mask_arrays(data.columns[0])
+            t = time.time() - startTime
+            print "round trip of %d masks of %d bytes = %s secs" % (
+                rows, masks[0].size, t)
+            assert range(rows) == data.columns[0].imageId
+            for expected, actual in zip(masks, read):
+                assert numpy.array_equal(expected, actual)
+        finally:
+            table.delete()
+            table.close()
+
 # TODO: Add tests for error conditions
@@ -29,6 +29,33 @@ from omero.testlib import ITest
 import pytest
 
 
+def readExport(exporter, length, blockSize=1000 * 1000):
+    """
+    Yield the generated file from exporter in blocks of at most
+    blockSize bytes. The read of the next block is issued before the
+    current one is handed to the caller, so that the download overlaps
+    with whatever the caller does with the data. An exception is raised
+    if the exporter stops returning data before length bytes are read.
+    """
+    offset = 0
+    pending = None
+    if length:
+        pending = exporter.begin_read(offset, min(blockSize, length))
+    while pending is not None:
+        rv = exporter.end_read(pending)
+        rv = rv[:min(blockSize, length - offset)]
+        offset += len(rv)
+        pending = None
+        if not rv and offset < length:
+            raise Exception(
+                "Export truncated at %s of %s bytes" % (offset, length))
+        if rv and offset < length:
+            pending = exporter.begin_read(
+                offset, min(blockSize, length - offset))
+        if rv:
+            yield rv
+
+
 class TestExporter(ITest):
 
     def bigimage(self):
@@ -59,6 +86,27 @@ class TestExporter(ITest):
             rv = rv[:min(1000 * 1000, length - offset)]
             offset += len(rv)
 
+    def testReadExport(self):
+        """
+        Reading the export with read-ahead returns the whole file,
+        whatever the block size
+        """
+        session = self.client.getSession()
+        image = self.create_test_image(512, 512, 1, 1, 1, session)
+        exporter = self.client.sf.createExporter()
+        try:
+            exporter.addImage(image.id.val)
+            length = exporter.generateTiff()
+            whole = "".join(readExport(exporter, length))
+            assert len(whole) == length
+            assert whole[:4] in ("II*\x00", "MM\x00*")  # TIFF header
+            for blockSize in (1000, 64 * 1024):
+                blocks = list(readExport(exporter, length, blockSize))
+                assert max(len(b) for b in blocks) <= blockSize
+                assert "".join(blocks) == whole
+        finally:
+            exporter.close()
+
     def test6713(self):
         """
         Tests that a big image will not be exportable.
@@ -10,16 +10,82 @@
 """
 
 import omero
+import Queue
 import threading
+import time
 from omero.testlib import ITest
 import pytest
 __import__("sys")
+from numpy import arange, empty, random
+from helpers import toPixelsBytes, waitForPyramid
 
 from omero.util.tiles import TileLoopIteration
 from omero.util.tiles import RPSTileLoop
 from binascii import hexlify as hex
 
 
+def writeTilesInParallel(sf, pid, sizeX, sizeY, tileSize, mktile,
+                         workers=4):
+    """
+    Write every tile of plane 0 of the given pixels using one
+    RawPixelsStore per worker thread. mktile(x, y, w, h) returns the
+    bytes of a tile. The queue between the caller and the workers is
+    bounded, so at most three tiles per worker are in memory. The
+    stores are only closed once all tiles have been written so that the
+    digest saved on close covers the whole image.
+    Each store saves the pixels again when it is closed, so the time
+    spent in the closes is returned for callers to report separately.
+    Images which need a pyramid are rejected with a ValueError, as the
+    server does not support several stores writing one pyramid.
+    """
+    tiles = Queue.Queue(maxsize=2 * workers)
+    errors = []
+    closeTime = 0
+
+    class Writer(threading.Thread):
+
+        def run(self):
+            while True:
+                tile = tiles.get()
+                if tile is None:
+                    return
+                x, y, w, h, buf = tile
+                try:
+                    self.rps.setTile(buf, 0, 0, 0, x, y, w, h)
+                except Exception, e:
+                    errors.append(e)
+
+    threads = []
+    try:
+        for n in range(workers):
+            t = Writer()
+            t.rps = sf.createRawPixelsStore()
+            threads.append(t)
+            t.rps.setPixelsId(pid, True)
+            if t.rps.requiresPixelsPyramid():
+                raise ValueError(
+                    "Pixels:%s requires a pyramid" % pid)
+            t.start()
+        for y in range(0, sizeY, tileSize):
+            for x in range(0, sizeX, tileSize):
+                w = min(tileSize, sizeX - x)
+                h = min(tileSize, sizeY - y)
+                tiles.put((x, y, w, h, mktile(x, y, w, h)))
+    finally:
+        started = [t for t in threads if t.isAlive()]
+        for t in started:
+            tiles.put(None)
+        for t in started:
+            t.join()
+        startTime = time.time()
+        for t in threads:
+            t.rps.close()
+        closeTime = time.time() - startTime
+    if errors:
+        raise errors[0]
+    return closeTime
+
+
 class TestRPS(ITest):
 
     def check_pix(self, pix):
@@ -62,8 +128,10 @@ class TestRPS(ITest):
 
             def run(self, data, z, c, t, x, y,
                     tileWidth, tileHeight, tileCount):
+                tile = empty(tileWidth * tileHeight)
+                tile.fill(5)
                 data.setTile(
-                    [5] * tileWidth * tileHeight,
+                    toPixelsBytes(tile, "int8"),
                     z, c, t, x, y, tileWidth, tileHeight)
 
         loop = RPSTileLoop(self.client.getSession(), pix)
@@ -81,6 +149,43 @@ class TestRPS(ITest):
             rps.close()
         self.check_pix(pix)
 
+    def testTileOrderDigest(self):
+        """
+        Times close(), which saves the digest of the pixels, after
+        writing a 3000x3000 plane as tiles in canonical and in reverse
+        order. Both orders must give the same, correct digest. The size
+        stays below the default omero.pixeldata.max_plane_width so that
+        close() re-reads the plane rather than finalising a pyramid
+        """
+        size = 3000
+        tileSize = 500
+        coords = [(x, y) for y in range(0, size, tileSize)
+                  for x in range(0, size, tileSize)]
+        data = {}
+        sha1s = []
+        for name, order in (("canonical", coords),
+                            ("reverse", coords[::-1])):
+            pix = self.create_pixels(x=size, y=size, z=1, t=1, c=1)
+            rps = self.client.sf.createRawPixelsStore()
+            try:
+                rps.setPixelsId(pix.id.val, True)
+                assert not rps.requiresPixelsPyramid()
+                length = tileSize * tileSize * rps.getByteWidth()
+                for x, y in order:
+                    if (x, y) not in data:
+                        data[(x, y)] = random.randint(
+                            0, 100, length).astype("uint8").tostring()
+                    rps.setTile(data[(x, y)], 0, 0, 0, x, y,
+                                tileSize, tileSize)
+            finally:
+                startTime = time.time()
+                rps.close()
+                t = time.time() - startTime
+            print "close after %s writes = %s secs" % (name, t)
+            self.check_pix(pix)
+            sha1s.append(self.query.get("Pixels", pix.id.val).sha1.val)
+        assert sha1s[0] == sha1s[1]
+
     def testRomioToPyramid(self, tmpdir):
         """
         Here we create a pixels that is not big,
@@ -88,7 +193,6 @@ class TestRPS(ITest):
         in order to trick the service into throwing
         us a MissingPyramidException
         """
-        from omero.util import concurrency
         pix = self.missing_pyramid()
         rps = self.sf.createRawPixelsStore()
         try:
@@ -100,19 +204,7 @@ class TestRPS(ITest):
                 assert long(pix) == mpm.pixelsID
 
             # Eventually, however, it should be generated
-            i = 10
-            success = False
-            while i > 0 and not success:
-                try:
-                    rps.setPixelsId(long(pix), True)
-                    success = True
-                except omero.MissingPyramidException, mpm:
-                    assert long(pix) == mpm.pixelsID
-                    backOff = mpm.backOff / 1000
-                    event = concurrency.get_event("testRomio")
-                    event.wait(backOff)  # seconds
-                i -= 1
-            assert success
+            assert waitForPyramid(rps, long(pix))
         finally:
             rps.close()
 
@@ -123,7 +215,6 @@ class TestRPS(ITest):
         """
         all_context = {"omero.group": "-1"}
 
-        from omero.util import concurrency
         pix = self.missing_pyramid()
         rps = self.sf.createRawPixelsStore(all_context)
         try:
@@ -135,19 +226,7 @@ class TestRPS(ITest):
                 assert long(pix) == mpm.pixelsID
 
             # Eventually, however, it should be generated
-            i = 10
-            success = False
-            while i > 0 and not success:
-                try:
-                    rps.setPixelsId(long(pix), True, all_context)
-                    success = True
-                except omero.MissingPyramidException, mpm:
-                    assert long(pix) == mpm.pixelsID
-                    backOff = mpm.backOff / 1000
-                    event = concurrency.get_event("testRomio")
-                    event.wait(backOff)  # seconds
-                i -= 1
-            assert success
+            assert waitForPyramid(rps, long(pix), ctx=all_context)
         finally:
             rps.close()
 
@@ -169,19 +248,7 @@ class TestRPS(ITest):
                 assert long(pix) == mpm.pixelsID
 
             # Eventually, however, it should be generated
-            i = 10
-            success = False
-            while i > 0 and not success:
-                try:
-                    rps.setPixelsId(long(pix), True, all_context)
-                    success = True
-                except omero.MissingPyramidException, mpm:
-                    assert long(pix) == mpm.pixelsID
-                    backOff = mpm.backOff / 1000
-                    event = concurrency.get_event("testRomio")
-                    event.wait(backOff)  # seconds
-                i -= 1
-            assert success
+            assert waitForPyramid(rps, long(pix), ctx=all_context)
 
             # Once it's generated, we should be able to concurrencly
             # access the file without exceptions
@@ -220,6 +287,52 @@ class TestRPS(ITest):
         finally:
             rps.close()
 
+    @pytest.mark.parametrize("count", [1, 10])
+    def testPyramidOpensPerSecond(self, count):
+        """
+        Measures how many times per second count threads, each with its
+        own RawPixelsStore, can open the same generated pyramid
+        """
+        pix = self.missing_pyramid()
+        rps = self.sf.createRawPixelsStore()
+        try:
+            assert waitForPyramid(rps, long(pix))
+        finally:
+            rps.close()
+
+        sf = self.sf
+        opens = 20
+
+        class T(threading.Thread):
+
+            def run(self):
+                self.success = 0
+                self.error = None
+                try:
+                    for n in range(opens):
+                        rps = sf.createRawPixelsStore()
+                        try:
+                            rps.setPixelsId(long(pix), True)
+                            self.success += 1
+                        finally:
+                            rps.close()
+                except Exception, e:
+                    self.error = e
+
+        threads = [T() for x in range(count)]
+        startTime = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - startTime
+
+        assert not [t.error for t in threads if t.error]
+        total = sum([t.success for t in threads])
+        assert total == count * opens
+        print "%d threads: %d opens in %s secs = %s opens/sec" % (
+            count, total, elapsed, total / elapsed)
+
 
 class TestTiles(ITest):
 
@@ -268,7 +381,7 @@ class TestTiles(ITest):
             tile = fromfunction(f, (w, h))
             tile = tile.astype(int)
             tile[tile > tile_max] = tile_max
-            return list(tile.flatten())
+            return toPixelsBytes(tile, "int8")
 
         tile = fromfunction(f, (tileWidth, tileHeight)).astype(int)
         tile_min = float(tile.min())
@@ -287,3 +400,123 @@ class TestTiles(ITest):
         c = 0
         pixelsService.setChannelGlobalMinMax(
             pid, c, tile_min, tile_max)
+
+    def createParallelTilesImage(self, size):
+        from omero.sys import ParametersI
+
+        query = "from PixelsType as p where p.value='int8'"
+        pixelsType = self.query.findByQuery(query, None)
+        iId = self.client.sf.getPixelsService().createImage(
+            size, size, 1, 1, [0], pixelsType, "testParallelTiles", None)
+        image = self.query.findByQuery(
+            "select i from Image i join fetch i.pixels where i.id = :id",
+            ParametersI().addId(iId))
+        return image.getPrimaryPixels().getId().getValue()
+
+    def mkParallelTile(self, x, y, w, h):
+        tile = (arange(w * h) + x + y) % 128
+        return toPixelsBytes(tile, "int8")
+
+    @pytest.mark.parametrize("size", [1024, 3072])
+    def testParallelTiles(self, size):
+        """
+        Writing tiles from several threads, each with its own
+        RawPixelsStore, must give the same digest as the serial
+        RPSTileLoop, and is timed against it. Sizes stay below the
+        default omero.pixeldata.max_plane_width so no pyramid is used
+        """
+        from omero.model import PixelsI
+
+        tileSize = 256
+        create = self.createParallelTilesImage
+        mktile = self.mkParallelTile
+
+        class Iteration(TileLoopIteration):
+
+            def run(self, rps, z, c, t, x, y, w, h, tileCount):
+                rps.setTile(mktile(x, y, w, h), z, c, t, x, y, w, h)
+
+        pid = create(size)
+        startTime = time.time()
+        loop = RPSTileLoop(self.client.sf, PixelsI(pid, False))
+        loop.forEachTile(tileSize, tileSize, Iteration())
+        t1 = time.time() - startTime
+        serial = self.query.get("Pixels", pid)
+
+        pid = create(size)
+        startTime = time.time()
+        t3 = writeTilesInParallel(
+            self.client.sf, pid, size, size, tileSize, mktile)
+        t2 = time.time() - startTime - t3
+        parallel = self.query.get("Pixels", pid)
+
+        print "%dx%d serial = %s secs" % (size, size, t1)
+        print "%dx%d parallel writes = %s secs, closes = %s secs" % (
+            size, size, t2, t3)
+        assert serial.sha1.val == parallel.sha1.val
+        rps = self.client.sf.createRawPixelsStore()
+        try:
+            rps.setPixelsId(pid, True)
+            assert hex(rps.calculateMessageDigest()) == parallel.sha1.val
+        finally:
+            rps.close()
+
+    def testParallelTilesPyramid(self):
+        pid = self.createParallelTilesImage(4096)
+        with pytest.raises(ValueError):
+            writeTilesInParallel(
+                self.client.sf, pid, 4096, 4096, 256, self.mkParallelTile)
+
+    @pytest.mark.parametrize("pixelsType", ["int8", "uint16", "float"])
+    def testTilesFromBuffers(self, pixelsType):
+        """
+        Writing tiles as byte strings built from numpy arrays must give
+        the same pixels as writing them as lists of values, and is timed
+        against that path
+        """
+        from omero.model import PixelsI
+        from omero.sys import ParametersI
+
+        size = 2048
+        tileSize = 256
+        data = random.randint(0, 100, (size, size))
+
+        def create():
+            query = "from PixelsType as p where p.value='%s'" % pixelsType
+            pt = self.query.findByQuery(query, None)
+            iId = self.client.sf.getPixelsService().createImage(
+                size, size, 1, 1, [0], pt, "testTilesFromBuffers", None)
+            image = self.query.findByQuery(
+                "select i from Image i join fetch i.pixels where i.id = :id",
+                ParametersI().addId(iId))
+            return image.getPrimaryPixels().getId().getValue()
+
+        class ListIteration(TileLoopIteration):
+
+            def run(self, rps, z, c, t, x, y, w, h, tileCount):
+                tile = toPixelsBytes(data[y:y + h, x:x + w], pixelsType)
+                rps.setTile([ord(b) for b in tile], z, c, t, x, y, w, h)
+
+        class BufferIteration(TileLoopIteration):
+
+            def run(self, rps, z, c, t, x, y, w, h, tileCount):
+                tile = toPixelsBytes(data[y:y + h, x:x + w], pixelsType)
+                rps.setTile(tile, z, c, t, x, y, w, h)
+
+        sha1s = []
+        for name, iteration in (("list", ListIteration()),
+                                ("buffer", BufferIteration())):
+            pid = create()
+            loop = RPSTileLoop(self.client.sf, PixelsI(pid, False))
+            startTime = time.time()
+            loop.forEachTile(tileSize, tileSize, iteration)
+            t = time.time() - startTime
+            print "%s write of %dx%d %s = %s secs" % (
+                name, size, size, pixelsType, t)
+            rps = self.client.sf.createRawPixelsStore()
+            try:
+                rps.setPixelsId(pid, True)
+                sha1s.append(hex(rps.calculateMessageDigest()))
+            finally:
+                rps.close()
+        assert sha1s[0] == sha1s[1]
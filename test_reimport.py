@@ -63,14 +63,28 @@ class TestReimportArchivedFiles(ITest):
         return new_img, new_pix
 
     def copyPixels(self, orig_pix, new_pix):
+        """
+        Copy every plane of new_pix from orig_pix. The read of the next
+        plane is issued before the current one is written, so that at
+        most two planes are held on the client.
+        """
+        new = self.query.get("Pixels", new_pix.id.val)
+        zcts = [(z, c, t)
+                for t in range(new.sizeT.val)
+                for c in range(new.sizeC.val)
+                for z in range(new.sizeZ.val)]
         orig_source = self.client.sf.createRawPixelsStore()
         new_sink = self.client.sf.createRawPixelsStore()
 
         try:
             orig_source.setPixelsId(orig_pix.id.val, False)
             new_sink.setPixelsId(new_pix.id.val, False)
-            buf = orig_source.getPlane(0, 0, 0)
-            new_sink.setPlane(buf, 0, 0, 0)
+            pending = orig_source.begin_getPlane(*zcts[0])
+            for idx, (z, c, t) in enumerate(zcts):
+                buf = orig_source.end_getPlane(pending)
+                if idx + 1 < len(zcts):
+                    pending = orig_source.begin_getPlane(*zcts[idx + 1])
+                new_sink.setPlane(buf, z, c, t)
         finally:
             orig_source.close()
             new_sink.close()
@@ -204,6 +218,41 @@ class TestReimportArchivedFiles(ITest):
         assert pyramidSize == rsp.pyramidSize
         assert thumbnailSize == rsp.thumbnailSize
 
+    def testCopyPixelsAllPlanes(self):
+        """
+        copyPixels must copy every plane, giving a synthetic image with
+        the same pixel data as the original
+        """
+        from binascii import hexlify
+        import time
+
+        orig_img = self.import_fake_file(
+            name="copyPixels", sizeX=256, sizeY=256, sizeZ=3, sizeC=2,
+            sizeT=2)[0]
+        orig_pix = self.query.findByQuery(
+            "select p from Pixels p where p.image.id = :id",
+            ParametersI().addId(orig_img.id.val))
+        new_img = self.pixels.copyAndResizeImage(
+            orig_img.id.val, rint(256), rint(256), rint(3), rint(2),
+            [0, 1], None, True).val
+        new_pix = self.query.findByQuery(
+            "select p from Pixels p where p.image.id = :id",
+            ParametersI().addId(new_img))
+
+        startTime = time.time()
+        self.copyPixels(orig_pix, new_pix)
+        print "copy of 12 planes = %s secs" % (time.time() - startTime)
+
+        digests = []
+        for pix in (orig_pix, new_pix):
+            rps = self.client.sf.createRawPixelsStore()
+            try:
+                rps.setPixelsId(pix.id.val, False)
+                digests.append(hexlify(rps.calculateMessageDigest()))
+            finally:
+                rps.close()
+        assert digests[0] == digests[1]
+
     def testConvertSynthetic(self):
         """
         Convert a pre-FS file to FS
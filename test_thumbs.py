@@ -12,10 +12,9 @@
 from omero.testlib import ITest
 import pytest
 
-from omero import MissingPyramidException
 from omero.sys import ParametersI
-from omero.util.concurrency import get_event
 from omero.rtypes import rint, unwrap
+from helpers import waitForPyramid
 
 
 class TestThumbs(ITest):
@@ -126,18 +125,13 @@ class TestThumbs(ITest):
 
         # Now we wait until the pyramid has been created
         # and test that a proper version has been set.
-        event = get_event("test_thumbs")
         secs = 20
         rps = self.client.sf.createRawPixelsStore()
-        for x in range(secs):
-            try:
-                rps.setPixelsId(long(pix), True)
-                event = None
-                break
-            except MissingPyramidException:
-                event.wait(1)
-        if event:
-            assert "Pyramid was not generated %ss" % secs
+        try:
+            assert waitForPyramid(rps, long(pix), timeout=secs), \
+                "Pyramid was not generated %ss" % secs
+        finally:
+            rps.close()
 
         if meth == "one":
             # Re-load the thumbnail store now that